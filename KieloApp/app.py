@@ -1,22 +1,52 @@
 import os
-import uuid
+import re
+import queue
+import atexit
+import asyncio
+import hmac
+import time
+import hashlib
+import secrets
 import logging
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
 from typing import List, Dict
 import uvicorn
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG, filename='app_debug.log', 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Set up logging: request handlers only enqueue records, a background thread
+# writes them to disk. Set KIELO_LOG_LEVEL=DEBUG for verbose logs.
+# Every worker process appends to the same file, so rotation is left to an
+# external tool such as logrotate; WatchedFileHandler reopens the file after
+# it has been moved, where an in-process rollover would strand the others.
+_log_queue=queue.Queue(-1)
+_log_file_handler=WatchedFileHandler('app_debug.log',encoding='utf-8')
+_log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_listener=QueueListener(_log_queue,_log_file_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+# The queue handler only renders the message; the file handler adds the rest
+logging.basicConfig(level=os.environ.get("KIELO_LOG_LEVEL","INFO").upper(),format='%(message)s',handlers=[QueueHandler(_log_queue)])
 
+import jwt
 from fastapi import FastAPI, HTTPException, status
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
 from fastapi.staticfiles import StaticFiles
+import httpx
+from openai import BadRequestError, OpenAIError, RateLimitError
 from pydantic import BaseModel
 
 from wordgrammarchecker import WordGrammarChecker
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Load users and static pages before serving; close the shared OpenAI
+    # clients and the response log on shutdown
+    await load_startup_data()
+    yield
+    await WordGrammarChecker.aclose()
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 system_prompt = """
@@ -82,35 +112,116 @@ Korjattu lause:
 Varmista lopuksi, että koko teksti on sujuvaa ja ymmärrettävää  kieltä. 
 """
 
+# Hashed once at import; identifies the shared system prompt to OpenAI's
+# prompt cache so requests from all users can reuse the cached prefix
+SYSTEM_PROMPT_HASH=hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+
+
 
+# One Username/Password/API-Key block per user; blank lines between the lines
+# are allowed and quotes around the API key are dropped. The password is the
+# rest of its line, so it may contain spaces.
+USER_BLOCK_PATTERN=re.compile(
+    r'^\s*Username:\s*(\S+)\s*\n\s*Password:[ \t]*([^\r\n]+?)[ \t]*\r?\n\s*API-Key:\s*"?([^"\r\n]+?)"?\s*$',
+    re.M
+)
+USERNAME_LINE_PATTERN=re.compile(r'^\s*Username:',re.M)
 
 def load_users(filename="users.txt"):
     users=[]
     if os.path.exists(filename):
         with open(filename,"r",encoding="utf-8") as f:
-            lines=f.read().strip().split("\n")
-            block=[]
-            for line in lines:
-                line=line.strip()
-                if line:
-                    block.append(line)
-                    if len(block)==3:
-                        user_line=block[0]
-                        pass_line=block[1]
-                        key_line=block[2]
-                        u=user_line.split(":",1)[1].strip()
-                        p=pass_line.split(":",1)[1].strip()
-                        k=key_line.split(":",1)[1].strip()
-                        # Remove quotes from API key if present
-                        if k.startswith('"') and k.endswith('"'):
-                            k = k[1:-1]
-                        logging.debug(f"Loaded user: {u}, API Key first 10 chars: {k[:10]}...")
-                        users.append((u,p,k))
-                        block=[]
+            text=f.read()
+        users=[(m.group(1),m.group(2),m.group(3)) for m in USER_BLOCK_PATTERN.finditer(text)]
+        skipped=len(USERNAME_LINE_PATTERN.findall(text))-len(users)
+        if skipped>0:
+            logging.warning(f"Skipped {skipped} malformed user block(s) in {filename}")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for(u,p,k) in users:
+                logging.debug(f"Loaded user: {u}, API Key first 10 chars: {k[:10]}...")
     return users
 
-USERS=load_users()
-SESSIONS:Dict[str,tuple]={}
+def index_users(users):
+    # username -> (sha256(password), api_key); the first entry wins on duplicates
+    index={}
+    for(u,p,k) in users:
+        index.setdefault(u,(hashlib.sha256(p.encode("utf-8")).digest(),k))
+    return index
+
+def read_static_pages(names=("manifest.xml","taskpane.html")):
+    # Pages served from memory; a restart is needed to pick up edits
+    pages={}
+    for name in names:
+        path=os.path.join("static",name)
+        if os.path.isfile(path):
+            with open(path,"rb") as f:
+                pages[name]=f.read()
+    return pages
+
+def api_key_id(api_key):
+    # Opaque reference to an API key, stable across processes, so the key
+    # itself never travels to the client inside a session token
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+# Populated on startup, off the event loop
+USERS=[]
+USERS_BY_NAME={}
+API_KEYS_BY_ID:Dict[str,str]={}
+STATIC_PAGES:Dict[str,bytes]={}
+# Compared against for unknown usernames so both paths take the same time
+_DUMMY_PASSWORD_HASH=hashlib.sha256(b"").digest()
+
+# Sessions are signed JWTs, so no session state is kept on the server. All
+# workers must share the secret: __main__ exports a generated one to the
+# workers it spawns, other deployments should set KIELO_JWT_SECRET.
+JWT_SECRET=os.environ.get("KIELO_JWT_SECRET") or secrets.token_hex(32)
+if not os.environ.get("KIELO_JWT_SECRET") and __name__!="__main__":
+    # Imported by an external server such as gunicorn (startup.txt): each
+    # worker would sign tokens with its own secret and reject the others'
+    if int(os.environ.get("WEB_CONCURRENCY",1))>1:
+        raise RuntimeError("KIELO_JWT_SECRET must be set when running several workers")
+    logging.warning("KIELO_JWT_SECRET is not set; sessions use a per-process secret and end on restart")
+JWT_ALGORITHM="HS256"
+SESSION_TTL_SECONDS=int(os.environ.get("KIELO_SESSION_TTL",3600))
+
+# Cheap request checks done before any checker or OpenAI work. Tabs and line
+# breaks are allowed: Word's paragraph.text uses \x0b for manual line breaks.
+MAX_INPUT_CHARS=int(os.environ.get("KIELO_MAX_INPUT_CHARS",50000))
+MAX_N_RESPONSES=int(os.environ.get("KIELO_MAX_N_RESPONSES",5))
+CONTROL_CHARS_PATTERN=re.compile(r"[\x00-\x08\x0e-\x1f\x7f]")
+BLANK_LINES_PATTERN=re.compile(r"\n{3,}")
+
+def normalize_text(text):
+    """
+    Collapse spaces and tabs within each line and runs of blank lines, keeping
+    line breaks. Only used to derive cache keys: the model gets the text as
+    written, so its original_sentence values can be found in the document.
+    """
+    lines=[" ".join(line.split()) for line in text.splitlines()]
+    return BLANK_LINES_PATTERN.sub("\n\n","\n".join(lines)).strip("\n")
+
+# (API key id, model, n_responses, blake2b digest) -> expiry time of requests
+# that OpenAI rejected as invalid, so that immediate retries of the same text are refused
+# cheaply. Transient failures (outages, rate limits, a bad key) are not
+# recorded, and one user's rejection does not block other users.
+BAD_INPUT_TTL_SECONDS=int(os.environ.get("KIELO_BAD_INPUT_TTL",60))
+_RECENT_BAD_INPUTS_MAX=1024
+_recent_bad_inputs:Dict[tuple,float]={}
+
+def is_recent_bad_input(key):
+    expires=_recent_bad_inputs.get(key)
+    if expires is None:
+        return False
+    if expires<time.monotonic():
+        del _recent_bad_inputs[key]
+        return False
+    return True
+
+def remember_bad_input(key):
+    _recent_bad_inputs.pop(key,None)
+    _recent_bad_inputs[key]=time.monotonic()+BAD_INPUT_TTL_SECONDS
+    while len(_recent_bad_inputs)>_RECENT_BAD_INPUTS_MAX:
+        del _recent_bad_inputs[next(iter(_recent_bad_inputs))]
 
 class LoginRequest(BaseModel):
     username:str
@@ -126,48 +237,82 @@ class ProcessSectionsRequest(BaseModel):
 class LogErrorRequest(BaseModel):
     error:str
 
+async def load_startup_data():
+    global USERS,USERS_BY_NAME,API_KEYS_BY_ID,STATIC_PAGES
+    USERS=await asyncio.to_thread(load_users)
+    USERS_BY_NAME=index_users(USERS)
+    API_KEYS_BY_ID={api_key_id(k):k for(u,p,k) in USERS}
+    STATIC_PAGES=await asyncio.to_thread(read_static_pages)
+
 @app.get("/")
 async def index():
     return {"message":"Backend is running. Access /static/taskpane.html."}
 
 @app.get("/manifest.xml")
 async def serve_manifest():
-    path=os.path.join("static","manifest.xml")
-    if os.path.isfile(path):
-        return FileResponse(path,media_type="application/xml")
+    content=STATIC_PAGES.get("manifest.xml")
+    if content is not None:
+        return Response(content,media_type="application/xml")
     raise HTTPException(status_code=404,detail="manifest.xml not found")
 
 @app.get("/taskpane.html")
 async def serve_taskpane():
-    path=os.path.join("static","taskpane.html")
-    if os.path.isfile(path):
-        return FileResponse(path,media_type="text/html")
+    content=STATIC_PAGES.get("taskpane.html")
+    if content is not None:
+        return Response(content,media_type="text/html")
     raise HTTPException(status_code=404,detail="taskpane.html not found")
 
 @app.post("/login")
 async def login(login_data:LoginRequest):
     username=login_data.username
-    password=login_data.password
-    for(u,p,k) in USERS:
-        if u==username and p==password:
-            token=str(uuid.uuid4())
-            SESSIONS[token]=(u,k)
-            logging.debug(f"User {u} logged in. Session token: {token[:8]}..., API Key first 10 chars: {k[:10]}...")
-            return {"session_token":token}
+    password_hash=hashlib.sha256(login_data.password.encode("utf-8")).digest()
+    entry=USERS_BY_NAME.get(username)
+    stored_hash,k=entry if entry is not None else (_DUMMY_PASSWORD_HASH,None)
+    if hmac.compare_digest(stored_hash,password_hash) and entry is not None:
+        claims={"u":username,"k_id":api_key_id(k),"exp":int(time.time())+SESSION_TTL_SECONDS}
+        token=jwt.encode(claims,JWT_SECRET,algorithm=JWT_ALGORITHM)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"User {username} logged in. Session token: {token[:8]}..., API Key first 10 chars: {k[:10]}...")
+        return {"session_token":token}
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,detail="Invalid credentials")
 
 @app.post("/process_sections")
 async def process_sections(data:ProcessSectionsRequest):
-    session_token=data.session_token
-    if session_token not in SESSIONS:
+    try:
+        claims=jwt.decode(data.session_token,JWT_SECRET,algorithms=[JWT_ALGORITHM])
+    except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Not logged in")
 
-    username,api_key=SESSIONS[session_token]
-    logging.debug(f"Processing request for user {username}. API Key first 10 chars: {api_key[:10]}...")
+    username=claims.get("u")
+    api_key=API_KEYS_BY_ID.get(claims.get("k_id"))
+    if api_key is None:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Processing request for user {username}. API Key first 10 chars: {api_key[:10]}...")
 
-    if not data.selected_titles or not data.text_for_corrections.strip():
+    if len(data.text_for_corrections)>MAX_INPUT_CHARS:
+        raise HTTPException(status_code=413, detail=f"Text is too long (max {MAX_INPUT_CHARS} characters).")
+    if CONTROL_CHARS_PATTERN.search(data.text_for_corrections):
+        raise HTTPException(status_code=400, detail="Text contains invalid control characters.")
+    if not 1<=data.n_responses<=MAX_N_RESPONSES:
+        raise HTTPException(status_code=400, detail=f"n_responses must be between 1 and {MAX_N_RESPONSES}.")
+
+    # The model checks the text as written; the normalized form only keys the
+    # caches, so whitespace-only differences map to the same entries
+    text=data.text_for_corrections.strip()
+    normalized_text=normalize_text(text)
+    if not data.selected_titles or not normalized_text:
         raise HTTPException(status_code=400, detail="No sections or text provided.")
 
+    bad_input_key=(
+        claims.get("k_id"),
+        data.selected_model,
+        data.n_responses,
+        hashlib.blake2b(normalized_text.encode("utf-8")).digest()
+    )
+    if is_recent_bad_input(bad_input_key):
+        raise HTTPException(status_code=400, detail="Processing this text failed moments ago. Try again later.")
+
     # If user selected "slow" => WordGrammarChecker uses "o3-mini" + reasoning_effort
     # If "fast" => gpt-4o
     chosen_model = data.selected_model  # "slow" or "fast"
@@ -177,11 +322,12 @@ async def process_sections(data:ProcessSectionsRequest):
         system_prompt,
         n_responses=data.n_responses,
         chosen_model=chosen_model,
-        use_discriminator=True  # Enable o3 discriminator for quality validation
+        use_discriminator=True,  # Enable o3 discriminator for quality validation
+        prompt_cache_key=SYSTEM_PROMPT_HASH
     )
 
     try:
-        results_per_response,_ = await checker.process_text(data.text_for_corrections)
+        results_per_response,_ = await checker.process_text(text,cache_text=normalized_text)
         # results_per_response => [([corr...], suggestion), ...]
         output=[]
         for i,(corrs,sugg) in enumerate(results_per_response,start=1):
@@ -191,6 +337,14 @@ async def process_sections(data:ProcessSectionsRequest):
                 "suggestion": sugg
             })
         return {"results": output}
+    except BadRequestError as e:
+        # The model refused this text itself, so retrying it right away is pointless
+        remember_bad_input(bad_input_key)
+        raise HTTPException(status_code=400, detail=str(e))
+    except RateLimitError as e:
+        raise HTTPException(status_code=503, detail=f"The language model is busy, try again shortly: {e}")
+    except (OpenAIError, httpx.HTTPError) as e:
+        raise HTTPException(status_code=502, detail=f"The language model request failed: {e}")
     except Exception as e:
         #logging.exception("Error processing sections: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -206,5 +360,11 @@ async def log_error(req:LogErrorRequest):
 async def apply_correction():
     return {"status":"success"}
 
+def default_worker_count():
+    # Requests spend most of their time waiting on OpenAI, so oversubscribe the CPUs
+    return (os.cpu_count() or 1)*2+1
+
 if __name__=="__main__":
-    uvicorn.run(app,host="0.0.0.0",port=5000)
+    os.environ.setdefault("KIELO_JWT_SECRET",JWT_SECRET)
+    workers=int(os.environ.get("WEB_CONCURRENCY",default_worker_count()))
+    uvicorn.run("app:app",host="0.0.0.0",port=5000,workers=workers,loop="uvloop",http="httptools")
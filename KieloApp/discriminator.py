@@ -7,35 +7,292 @@ in the correct JSON structure.
 """
 
 import asyncio
-import json
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional, Tuple
-from openai import AsyncOpenAI
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
+import ijson
+import Levenshtein
+import orjson
+from openai import AsyncOpenAI, RateLimitError
+from pydantic import BaseModel
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+from openai_clients import get_client
+
+# Optional: HFST bindings for the Finnish lexicon used by the local pre-filter
+try:
+    import hfst
+except ImportError:
+    hfst = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class ValidationResult(BaseModel):
+    """Verdict of the discriminator model for one list of corrections."""
+    valid_corrections: List[Dict[str, Any]]
+    # Rejections carry free-form reasons, so their shape is not enforced
+    rejected_corrections: List[Any] = []
+    quality_score: int = 0
+    summary: str = ""
+    error: Optional[str] = None
+
+
+class BatchValidationItem(ValidationResult):
+    """Verdict for one batch in a combined validation response."""
+    id: int
+
+
+class BatchValidationResponse(BaseModel):
+    """Combined validation response covering several batches."""
+    results: List[BatchValidationItem] = []
+
+
+class VerdictCache:
+    """
+    LRU cache for discriminator verdicts with optional SQLite persistence.
+    Entries expire after ttl seconds; persisted entries survive restarts.
+    The database file is created on the first write, and expired rows are
+    deleted at most every purge_interval seconds.
+    """
+
+    purge_interval = 600
+
+    def __init__(self, max_entries: int = 1024, ttl: int = 3600, db_path: Optional[str] = None):
+        """
+        Initialize the cache.
+        
+        Args:
+            max_entries: Maximum number of verdicts kept in memory
+            ttl: Time-to-live of a verdict in seconds
+            db_path: SQLite file for persistence, or None for memory only
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries: "OrderedDict[str, Tuple[float, ValidationResult]]" = OrderedDict()
+        self._table_ready = False
+        self._next_purge = 0.0
+
+    @staticmethod
+    def make_key(model: str, corrections: List[Dict[str, Any]], original_text: str) -> str:
+        """Return the SHA-256 key of the canonical JSON of a validation request."""
+        canonical_json = orjson.dumps(
+            {"model": model, "corrections": corrections, "original_text": original_text},
+            option=orjson.OPT_SORT_KEYS
+        )
+        return hashlib.sha256(canonical_json).hexdigest()
+
+    async def get(self, key: str) -> Optional[ValidationResult]:
+        """Return the cached verdict for key, or None on a miss."""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > now:
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+        
+        if self.db_path:
+            try:
+                row = await asyncio.to_thread(self._load, key, now)
+            except sqlite3.Error as e:
+                logger.error(f"Verdict cache read failed: {e}")
+                return None
+            if row is not None:
+                expires, value = row[0], ValidationResult.model_validate_json(row[1])
+                self._remember(key, expires, value)
+                return value
+        return None
+
+    async def set(self, key: str, value: ValidationResult) -> None:
+        """Store a verdict in memory and, if enabled, on disk."""
+        expires = time.time() + self.ttl
+        self._remember(key, expires, value)
+        
+        if self.db_path:
+            try:
+                await asyncio.to_thread(self._store, key, expires, value.model_dump_json())
+            except sqlite3.Error as e:
+                logger.error(f"Verdict cache write failed: {e}")
+
+    def _remember(self, key: str, expires: float, value: ValidationResult) -> None:
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path)
+        if not self._table_ready:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts "
+                "(key TEXT PRIMARY KEY, expires REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            self._table_ready = True
+        return conn
+
+    def _load(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        # Reads must not create the database file
+        if not self._table_ready and not os.path.exists(self.db_path):
+            return None
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT expires, value FROM verdicts WHERE key = ? AND expires > ?",
+                (key, now)
+            ).fetchone()
+
+    def _store(self, key: str, expires: float, value: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO verdicts (key, expires, value) VALUES (?, ?, ?)",
+                (key, expires, value)
+            )
+            now = time.time()
+            if now >= self._next_purge:
+                conn.execute("DELETE FROM verdicts WHERE expires <= ?", (now,))
+                self._next_purge = now + self.purge_interval
+
+
+# Verdict cache shared by all discriminator instances. Set KIELO_VERDICT_CACHE_DB
+# to an empty string to keep the cache in memory only.
+_shared_cache = VerdictCache(db_path=os.environ.get("KIELO_VERDICT_CACHE_DB", "discriminator_cache.sqlite3") or None)
+
+
+class FinnishLexicon:
+    """
+    Finnish word lookup backed by an HFST morphological analyser.
+    The lexicon is unavailable unless the hfst package is installed and
+    KIELO_HFST_ANALYSER points to an optimized-lookup transducer file.
+    """
+
+    def __init__(self, analyser_path: Optional[str] = None):
+        """
+        Load the analyser.
+        
+        Args:
+            analyser_path: Path to an .hfstol analyser (defaults to KIELO_HFST_ANALYSER)
+        """
+        self._analyser = None
+        self._known: Dict[str, bool] = {}
+        analyser_path = analyser_path or os.environ.get("KIELO_HFST_ANALYSER")
+        if hfst is not None and analyser_path and os.path.isfile(analyser_path):
+            try:
+                self._analyser = hfst.HfstInputStream(analyser_path).read()
+            except Exception as e:
+                logger.error(f"Could not load Finnish analyser {analyser_path}: {e}")
+
+    @property
+    def available(self) -> bool:
+        return self._analyser is not None
+
+    def is_word(self, word: str) -> bool:
+        """Return True if the analyser recognises the word form."""
+        known = self._known.get(word)
+        if known is None:
+            known = bool(self._analyser.lookup(word) or self._analyser.lookup(word.lower()))
+            self._known[word] = known
+        return known
+
+
+_shared_lexicon = FinnishLexicon()
+
+# Caps concurrent discriminator model calls across all requests in this
+# process; app.py creates a new discriminator for every request
+_shared_semaphore = asyncio.Semaphore(int(os.environ.get("KIELO_MAX_CONCURRENCY", 8)))
+
+_WORD_PATTERN = re.compile(r"\w+(?:-\w+)*")
+
+
+class _CompletionStreamReader:
+    """
+    Async file-like view over a streamed chat completion, for ijson.
+    Content deltas are handed out in batches roughly every flush_interval
+    seconds instead of one parser call per token.
+    """
+
+    def __init__(self, stream, flush_interval: float = 0.05):
+        self._iterator = stream.__aiter__()
+        self._done = False
+        self.flush_interval = flush_interval
+        self.parts: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """Content received so far."""
+        return "".join(self.parts)
+
+    async def read(self, size: int = -1) -> bytes:
+        # ijson probes the return type with read(0); that must not consume data
+        if self._done or size == 0:
+            return b""
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        batch = []
+        while True:
+            try:
+                chunk = await self._iterator.__anext__()
+            except StopAsyncIteration:
+                self._done = True
+                break
+            if chunk.choices and chunk.choices[0].delta.content:
+                batch.append(chunk.choices[0].delta.content)
+            if batch and loop.time() >= deadline:
+                break
+        
+        content = "".join(batch)
+        self.parts.append(content)
+        return content.encode("utf-8")
+
+
 class GrammarDiscriminator:
     """
     Discriminator agent for validating Finnish grammar corrections.
     Uses o3 model to evaluate and filter correction suggestions.
     """
-    
-    def __init__(self, api_key: str):
+
+    def __init__(
+        self,
+        api_key: str,
+        client: Optional[AsyncOpenAI] = None,
+        cache: Optional[VerdictCache] = None,
+        lexicon: Optional[FinnishLexicon] = None
+    ):
         """
         Initialize the discriminator with OpenAI API key.
         
         Args:
             api_key (str): OpenAI API key for accessing o3 model
+            client: Optional AsyncOpenAI client to reuse instead of the shared one
+            cache: Optional verdict cache to use instead of the shared one
+            lexicon: Optional lexicon for the local pre-filter instead of the shared one
         """
-        self.client = AsyncOpenAI(api_key=api_key)
+        # The shared client multiplexes concurrent batch_validate calls over
+        # HTTP/2 and is closed together with the checker's on shutdown
+        self.client = client or get_client(api_key)
+        # Rate limits are retried by _create_completion; SDK retries on top of
+        # that would multiply the attempts per call
+        self._api = self.client.with_options(max_retries=0)
         self.model = "o3"  # Using o3 model as specified
+        self.cache = cache or _shared_cache
+        self.lexicon = lexicon or _shared_lexicon
+        self._sem = _shared_semaphore
+        self.system_message = "Olet asiantuntija suomen kielen kieliopin arvioitsija. Vastaa aina JSON-muodossa."
         
-        # Validation prompt for the discriminator
+        # Validation prompt for the discriminator. It contains no per-request data
+        # and is sent ahead of the corrections, so every request shares the same
+        # prompt prefix and can hit the provider's prompt cache.
         self.validation_prompt = """
-Olet asiantuntija suomen kielen kieliopin tarkastaja. Tehtäväsi on arvioida annettujen kielioppikorjausten laatua ja oikeellisuutta.
+Olet asiantuntija suomen kielen kieliopin tarkastaja. Tehtäväsi on arvioida annettujen kielioppikorjausten laatua ja oikeellisuutta. Arvioitavat korjaukset annetaan seuraavassa viestissä.
 
 ARVIOINTIKRITEERIT:
 1. Onko alkuperäisessä lauseessa todella virhe?
@@ -44,9 +301,6 @@ ARVIOINTIKRITEERIT:
 4. Onko selitys selkeä ja perusteltu?
 5. Onko korjaus tarpeellinen ja hyödyllinen?
 
-ARVIOITAVAT KORJAUKSET:
-{corrections_json}
-
 VASTAUSOHJE:
 Palauta JSON-objekti, joka sisältää:
 1. "valid_corrections": Lista hyväksytyistä korjauksista (alkuperäisessä muodossa)
@@ -62,11 +316,204 @@ HYVÄKSYMISKYNNYS:
 Vastaa VAIN JSON-muodossa ilman lisäselityksiä.
 """
 
+        # Validation prompt for evaluating several correction batches in one call
+        self.batch_validation_prompt = """
+Olet asiantuntija suomen kielen kieliopin tarkastaja. Tehtäväsi on arvioida useiden korjauserien laatua ja oikeellisuutta. Arvioitavat korjauserät annetaan seuraavassa viestissä. Arvioi jokainen erä erikseen sen oman kontekstin perusteella.
+
+ARVIOINTIKRITEERIT:
+1. Onko alkuperäisessä lauseessa todella virhe?
+2. Onko ehdotettu korjaus kieliopillisesti oikein?
+3. Säilyykö lauseen alkuperäinen merkitys?
+4. Onko selitys selkeä ja perusteltu?
+5. Onko korjaus tarpeellinen ja hyödyllinen?
+
+VASTAUSOHJE:
+Palauta JSON-objekti, jossa on kenttä "results": lista, jossa on yksi objekti jokaista erää kohden. Jokainen objekti sisältää:
+1. "id": Erän tunniste samassa muodossa kuin syötteessä
+2. "valid_corrections": Lista erän hyväksytyistä korjauksista (alkuperäisessä muodossa)
+3. "rejected_corrections": Lista erän hylätyistä korjauksista syineen
+4. "quality_score": Erän kokonaislaatupisteet 0-100
+5. "summary": Lyhyt yhteenveto erän arvioinnista
+
+HYVÄKSYMISKYNNYS:
+- Hyväksy vain korjaukset, jotka ovat selvästi tarpeellisia ja oikeita
+- Hylkää epäselvät, tarpeettomat tai virheelliset korjaukset
+- Hylkää korjaukset, jotka muuttavat merkitystä perusteettomasti
+
+Vastaa VAIN JSON-muodossa ilman lisäselityksiä.
+"""
+
+    # Corrections at most this many character edits away from the original are
+    # accepted locally when they only turn unknown words into lexicon words.
+    max_auto_valid_distance = 2
+
+    # Upper bound (in characters) for the batches serialized into a single
+    # combined validation request; larger workloads are split into groups.
+    max_combined_chars = 40000
+
+    def _partition_corrections(
+        self,
+        corrections: List[Dict[str, Any]]
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Decide trivially scorable corrections locally before calling the model.
+        
+        Corrections that do not change the sentence (ignoring whitespace) are
+        rejected. Short edits that only replace words unknown to the lexicon
+        with known words are accepted. Everything else needs the model.
+        
+        Args:
+            corrections: List of correction dictionaries
+            
+        Returns:
+            Tuple of (auto_valid, auto_rejected, needs_model)
+        """
+        auto_valid = []
+        auto_rejected = []
+        needs_model = []
+        for correction in corrections:
+            original = " ".join((correction.get("original_sentence") or "").split())
+            corrected = " ".join((correction.get("corrected_sentence") or "").split())
+            
+            if original == corrected:
+                auto_rejected.append({**correction, "reason": "Korjaus ei muuta lausetta."})
+            elif self._is_trivial_typo_fix(original, corrected):
+                auto_valid.append(correction)
+            else:
+                needs_model.append(correction)
+        return auto_valid, auto_rejected, needs_model
+
+    def _is_trivial_typo_fix(self, original: str, corrected: str) -> bool:
+        """Return True for a short edit that fixes misspelled words into lexicon words."""
+        if not self.lexicon.available:
+            return False
+        if Levenshtein.distance(original, corrected) > self.max_auto_valid_distance:
+            return False
+        
+        original_words = _WORD_PATTERN.findall(original)
+        corrected_words = _WORD_PATTERN.findall(corrected)
+        removed = [w for w in original_words if w not in corrected_words]
+        added = [w for w in corrected_words if w not in original_words]
+        if not removed or not added:
+            return False
+        return (all(self.lexicon.is_word(w) for w in added)
+                and not any(self.lexicon.is_word(w) for w in removed))
+
+    def _merge_local_verdicts(
+        self,
+        auto_valid: List[Dict[str, Any]],
+        auto_rejected: List[Dict[str, Any]],
+        validation_result: Optional[ValidationResult]
+    ) -> ValidationResult:
+        """
+        Merge locally decided corrections into a model validation result.
+        
+        Args:
+            auto_valid: Corrections accepted by the pre-filter
+            auto_rejected: Corrections rejected by the pre-filter
+            validation_result: Model result, or None if the model was not needed
+            
+        Returns:
+            Combined validation result
+        """
+        if validation_result is None:
+            return ValidationResult(
+                valid_corrections=auto_valid,
+                rejected_corrections=auto_rejected,
+                quality_score=100,
+                summary="Kaikki korjaukset arvioitiin paikallisesti."
+            )
+        if not auto_valid and not auto_rejected:
+            return validation_result
+        
+        return validation_result.model_copy(update={
+            "valid_corrections": auto_valid + validation_result.valid_corrections,
+            "rejected_corrections": auto_rejected + validation_result.rejected_corrections
+        })
+
+    @retry(
+        retry=retry_if_exception_type(RateLimitError),
+        wait=wait_exponential_jitter(1, 30),
+        stop=stop_after_attempt(6),
+        reraise=True
+    )
+    async def _create_completion(self, **kwargs):
+        """
+        Call the chat completions API within the concurrency limit.
+        Rate-limited calls are retried with jittered exponential backoff,
+        waiting outside the semaphore so other calls can proceed.
+        """
+        async with self._sem:
+            return await self._api.chat.completions.create(**kwargs)
+
+    @retry(
+        retry=retry_if_exception_type(RateLimitError),
+        wait=wait_exponential_jitter(1, 30),
+        stop=stop_after_attempt(6),
+        reraise=True
+    )
+    async def _open_stream(self, **kwargs):
+        """
+        Like _create_completion, but for streamed responses: the concurrency
+        slot stays taken while the body is read, and the caller must release
+        self._sem once it has finished with the stream.
+        """
+        await self._sem.acquire()
+        try:
+            return await self._api.chat.completions.create(**kwargs, stream=True)
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def _build_request(
+        self,
+        corrections: List[Dict[str, Any]],
+        original_text: str = ""
+    ) -> Dict[str, Any]:
+        """
+        Build the chat completion parameters for validating one correction list.
+        
+        Args:
+            corrections: List of correction dictionaries
+            original_text: Original text for context (optional)
+            
+        Returns:
+            Keyword arguments for client.chat.completions.create
+        """
+        # Prepare corrections for validation
+        corrections_json = orjson.dumps(corrections, option=orjson.OPT_INDENT_2).decode()
+        
+        # Add original text context if provided
+        corrections_message = f"ARVIOITAVAT KORJAUKSET:\n{corrections_json}"
+        if original_text:
+            corrections_message += f"\n\nALKUPERÄINEN TEKSTI KONTEKSTIKSI:\n{original_text}"
+        
+        return {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "system", 
+                    "content": self.system_message
+                },
+                {
+                    "role": "user", 
+                    "content": self.validation_prompt
+                },
+                {
+                    "role": "user", 
+                    "content": corrections_message
+                }
+            ],
+            # Note: o3 model only supports default temperature=1
+            "max_completion_tokens": 2000,  # Use max_completion_tokens for o3 model
+            "response_format": {"type": "json_object"}
+        }
+
     async def validate_corrections(
         self, 
         corrections: List[Dict[str, Any]], 
         original_text: str = ""
-    ) -> Dict[str, Any]:
+    ) -> ValidationResult:
         """
         Validate grammar corrections using the discriminator model.
         
@@ -75,56 +522,103 @@ Vastaa VAIN JSON-muodossa ilman lisäselityksiä.
             original_text: Original text for context (optional)
             
         Returns:
-            Dictionary with validated corrections and quality metrics
+            ValidationResult with validated corrections and quality metrics
         """
+        # Only the corrections that cannot be scored locally are sent to the model
+        auto_valid, auto_rejected, model_corrections = self._partition_corrections(corrections)
+        if not model_corrections:
+            logger.info(f"Discriminator pre-filter decided all {len(corrections)} corrections locally")
+            return self._merge_local_verdicts(auto_valid, auto_rejected, None)
+        
         try:
-            # Prepare corrections for validation
-            corrections_json = json.dumps(corrections, ensure_ascii=False, indent=2)
-            
-            # Add original text context if provided
-            prompt = self.validation_prompt.format(corrections_json=corrections_json)
-            if original_text:
-                prompt += f"\n\nALKUPERÄINEN TEKSTI KONTEKSTIKSI:\n{original_text}"
+            # Skip the model call entirely if this exact request was validated recently
+            cache_key = self.cache.make_key(self.model, model_corrections, original_text)
+            cached_result = await self.cache.get(cache_key)
+            if cached_result is not None:
+                logger.info("Discriminator validation served from cache")
+                return self._merge_local_verdicts(auto_valid, auto_rejected, cached_result)
             
             # Call o3 model for validation
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": "Olet asiantuntija suomen kielen kieliopin arvioitsija. Vastaa aina JSON-muodossa."
-                    },
-                    {
-                        "role": "user", 
-                        "content": prompt
-                    }
-                ],
-                # Note: o3 model only supports default temperature=1
-                max_completion_tokens=2000,  # Use max_completion_tokens for o3 model
-                response_format={"type": "json_object"}
+            response = await self._create_completion(
+                **self._build_request(model_corrections, original_text)
             )
             
             # Parse the validation result
-            validation_result = json.loads(response.choices[0].message.content)
+            validation_result = ValidationResult.model_validate_json(response.choices[0].message.content)
             
             # Log validation summary
             logger.info(f"Discriminator validation completed. "
-                       f"Valid: {len(validation_result.get('valid_corrections', []))}, "
-                       f"Rejected: {len(validation_result.get('rejected_corrections', []))}, "
-                       f"Quality Score: {validation_result.get('quality_score', 0)}")
+                       f"Valid: {len(validation_result.valid_corrections)}, "
+                       f"Rejected: {len(validation_result.rejected_corrections)}, "
+                       f"Quality Score: {validation_result.quality_score}")
             
-            return validation_result
+            await self.cache.set(cache_key, validation_result)
+            return self._merge_local_verdicts(auto_valid, auto_rejected, validation_result)
             
         except Exception as e:
             logger.error(f"Error in correction validation: {e}")
             # Fallback: return all corrections if validation fails
-            return {
-                "valid_corrections": corrections,
-                "rejected_corrections": [],
-                "quality_score": 50,
-                "summary": f"Validation failed: {str(e)}. Returned all corrections.",
-                "error": str(e)
-            }
+            return self._merge_local_verdicts(auto_valid, auto_rejected, ValidationResult(
+                valid_corrections=model_corrections,
+                rejected_corrections=[],
+                quality_score=50,
+                summary=f"Validation failed: {str(e)}. Returned all corrections.",
+                error=str(e)
+            ))
+
+    async def iter_valid_corrections(
+        self,
+        corrections: List[Dict[str, Any]],
+        original_text: str = ""
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream accepted corrections as soon as the model has emitted them.
+        
+        No quality threshold is applied, since the quality score only arrives
+        at the end of the response; use filter_corrections when it matters.
+        
+        Args:
+            corrections: List of correction dictionaries
+            original_text: Original text for context (optional)
+            
+        Yields:
+            Accepted correction dictionaries
+        """
+        auto_valid, auto_rejected, model_corrections = self._partition_corrections(corrections)
+        for correction in auto_valid:
+            yield correction
+        if not model_corrections:
+            return
+        
+        cache_key = self.cache.make_key(self.model, model_corrections, original_text)
+        cached_result = await self.cache.get(cache_key)
+        if cached_result is not None:
+            for correction in cached_result.valid_corrections:
+                yield correction
+            return
+        
+        yielded = 0
+        try:
+            stream = await self._open_stream(**self._build_request(model_corrections, original_text))
+            try:
+                reader = _CompletionStreamReader(stream)
+                async for correction in ijson.items(reader, "valid_corrections.item"):
+                    yielded += 1
+                    yield correction
+                
+                # Drain the rest of the response so the full verdict can be cached
+                while await reader.read():
+                    pass
+            finally:
+                self._sem.release()
+            await self.cache.set(cache_key, ValidationResult.model_validate_json(reader.text))
+            
+        except Exception as e:
+            logger.error(f"Error in streamed correction validation: {e}")
+            # Fallback: return all corrections if nothing was validated yet
+            if not yielded:
+                for correction in model_corrections:
+                    yield correction
 
     async def filter_corrections(
         self, 
@@ -144,10 +638,28 @@ Vastaa VAIN JSON-muodossa ilman lisäselityksiä.
             Tuple of (filtered_corrections, validation_metadata)
         """
         validation_result = await self.validate_corrections(corrections, original_text)
+        return self._apply_quality_filter(corrections, validation_result, min_quality_score)
+
+    def _apply_quality_filter(
+        self,
+        corrections: List[Dict[str, Any]],
+        validation_result: ValidationResult,
+        min_quality_score: int
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Apply the quality threshold to a validation result.
         
+        Args:
+            corrections: Corrections that were validated
+            validation_result: Result returned by the discriminator model
+            min_quality_score: Minimum quality score to accept results
+            
+        Returns:
+            Tuple of (filtered_corrections, validation_metadata)
+        """
         # Extract valid corrections
-        valid_corrections = validation_result.get("valid_corrections", [])
-        quality_score = validation_result.get("quality_score", 0)
+        valid_corrections = validation_result.valid_corrections
+        quality_score = validation_result.quality_score
         
         # Apply quality threshold
         if quality_score < min_quality_score:
@@ -161,9 +673,11 @@ Vastaa VAIN JSON-muodossa ilman lisäselityksiä.
             "quality_score": quality_score,
             "original_count": len(corrections),
             "filtered_count": len(valid_corrections),
-            "rejected_count": len(validation_result.get("rejected_corrections", [])),
-            "summary": validation_result.get("summary", ""),
-            "rejected_reasons": validation_result.get("rejected_corrections", [])
+            "rejected_count": len(validation_result.rejected_corrections),
+            "summary": validation_result.summary,
+            "rejected_reasons": validation_result.rejected_corrections,
+            # Set when validation failed and all corrections were passed through
+            "error": validation_result.error
         }
         
         return valid_corrections, metadata
@@ -171,44 +685,261 @@ Vastaa VAIN JSON-muodossa ilman lisäselityksiä.
     async def batch_validate(
         self, 
         correction_batches: List[List[Dict[str, Any]]], 
-        original_texts: List[str] = None
+        original_texts: List[str] = None,
+        min_quality_score: int = 70
     ) -> List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
         """
-        Validate multiple batches of corrections concurrently.
+        Validate multiple batches of corrections.
+        
+        Batches are combined into as few discriminator calls as possible; only
+        when the combined payload exceeds max_combined_chars are the groups
+        validated concurrently.
         
         Args:
             correction_batches: List of correction lists
             original_texts: List of original texts for context
+            min_quality_score: Minimum quality score to accept results
             
         Returns:
             List of (filtered_corrections, metadata) tuples
         """
-        if original_texts is None:
-            original_texts = [""] * len(correction_batches)
+        # Batches without a matching text are validated without context
+        original_texts = list(original_texts or [])
+        original_texts += [""] * (len(correction_batches) - len(original_texts))
         
-        # Create tasks for concurrent validation
-        tasks = [
-            self.filter_corrections(corrections, text)
-            for corrections, text in zip(correction_batches, original_texts)
-        ]
+        items = list(zip(range(len(correction_batches)), correction_batches, original_texts))
+        groups = self._group_batches(items)
         
-        # Execute all validations concurrently
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Execute all groups concurrently
+        group_results = await asyncio.gather(
+            *(self._validate_group(group, min_quality_score) for group in groups),
+            return_exceptions=True
+        )
         
         # Handle any exceptions
-        filtered_results = []
-        for i, result in enumerate(results):
+        results_by_index = {}
+        for group, result in zip(groups, group_results):
             if isinstance(result, Exception):
-                logger.error(f"Batch {i} validation failed: {result}")
+                for i, corrections, _ in group:
+                    logger.error(f"Batch {i} validation failed: {result}")
+                    # Fallback to original corrections
+                    results_by_index[i] = (
+                        corrections, 
+                        {"error": str(result), "discriminator_used": False}
+                    )
+            else:
+                results_by_index.update(result)
+        
+        return [results_by_index[i] for i in range(len(correction_batches))]
+
+    def _group_batches(
+        self,
+        items: List[Tuple[int, List[Dict[str, Any]], str]]
+    ) -> List[List[Tuple[int, List[Dict[str, Any]], str]]]:
+        """
+        Pack (index, corrections, text) items into groups that fit in one request.
+        
+        Items are sorted by serialized length first so that similarly sized
+        batches end up in the same group.
+        """
+        sized = sorted(
+            ((len(orjson.dumps(corrections)) + len(text), (i, corrections, text))
+             for i, corrections, text in items),
+            key=lambda pair: pair[0]
+        )
+        
+        groups = []
+        current = []
+        current_size = 0
+        for size, item in sized:
+            if current and current_size + size > self.max_combined_chars:
+                groups.append(current)
+                current = []
+                current_size = 0
+            current.append(item)
+            current_size += size
+        if current:
+            groups.append(current)
+        return groups
+
+    async def _validate_group(
+        self,
+        group: List[Tuple[int, List[Dict[str, Any]], str]],
+        min_quality_score: int
+    ) -> Dict[int, Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """
+        Validate a group of batches with a single discriminator call.
+        
+        Batches missing from the combined answer are validated separately.
+        
+        Returns:
+            Dictionary mapping batch index to (filtered_corrections, metadata)
+        """
+        local = {}
+        verdicts = {}
+        pending = []
+        for i, corrections, text in group:
+            auto_valid, auto_rejected, model_corrections = self._partition_corrections(corrections)
+            local[i] = (auto_valid, auto_rejected)
+            if not model_corrections:
+                verdicts[i] = self._merge_local_verdicts(auto_valid, auto_rejected, None)
+                continue
+            cached_result = await self.cache.get(self.cache.make_key(self.model, model_corrections, text))
+            if cached_result is not None:
+                verdicts[i] = self._merge_local_verdicts(auto_valid, auto_rejected, cached_result)
+            else:
+                pending.append((i, model_corrections, text))
+        
+        if len(pending) > 1:
+            try:
+                fresh = await self._validate_combined(pending)
+            except Exception as e:
+                logger.error(f"Combined validation failed, validating batches separately: {e}")
+                fresh = {}
+            for i, model_corrections, text in pending:
+                if i in fresh:
+                    await self.cache.set(self.cache.make_key(self.model, model_corrections, text), fresh[i])
+                    verdicts[i] = self._merge_local_verdicts(*local[i], fresh[i])
+        
+        results = {}
+        missing = []
+        for i, corrections, text in group:
+            if i in verdicts:
+                results[i] = self._apply_quality_filter(corrections, verdicts[i], min_quality_score)
+            else:
+                missing.append((i, corrections, text))
+        
+        if missing:
+            separate = await asyncio.gather(
+                *(self.filter_corrections(corrections, text, min_quality_score)
+                  for _, corrections, text in missing)
+            )
+            for (i, _, _), result in zip(missing, separate):
+                results[i] = result
+        
+        return results
+
+    async def _validate_combined(
+        self,
+        group: List[Tuple[int, List[Dict[str, Any]], str]]
+    ) -> Dict[int, ValidationResult]:
+        """
+        Call the discriminator model once for a whole group of batches.
+        
+        Returns:
+            Dictionary mapping batch index to its validation result
+        """
+        batches_json = orjson.dumps(
+            {"batches": [
+                {"id": i, "corrections": corrections, "context": text}
+                for i, corrections, text in group
+            ]},
+            option=orjson.OPT_INDENT_2
+        ).decode()
+        
+        response = await self._create_completion(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": self.system_message},
+                {"role": "user", "content": self.batch_validation_prompt},
+                {"role": "user", "content": f"ARVIOITAVAT KORJAUSERÄT:\n{batches_json}"}
+            ],
+            max_completion_tokens=min(2000 * len(group), 32000),
+            response_format={"type": "json_object"}
+        )
+        
+        payload = BatchValidationResponse.model_validate_json(response.choices[0].message.content)
+        verdicts = {result.id: result for result in payload.results}
+        
+        logger.info(f"Combined discriminator validation completed for {len(verdicts)}/{len(group)} batches")
+        return verdicts
+
+    async def submit_batch(
+        self,
+        correction_batches: List[List[Dict[str, Any]]],
+        original_texts: List[str] = None,
+        min_quality_score: int = 70,
+        poll_interval: float = 30.0
+    ) -> List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """
+        Validate batches of corrections through the OpenAI Batch API.
+        
+        Intended for offline runs (QA, large corpora): the requests are billed
+        at the batch discount but may take up to 24 hours to complete.
+        
+        Args:
+            correction_batches: List of correction lists
+            original_texts: List of original texts for context
+            min_quality_score: Minimum quality score to accept results
+            poll_interval: Seconds to wait between batch status checks
+            
+        Returns:
+            List of (filtered_corrections, metadata) tuples
+        """
+        # Batches without a matching text are validated without context
+        original_texts = list(original_texts or [])
+        original_texts += [""] * (len(correction_batches) - len(original_texts))
+        
+        # One JSONL request line per correction batch
+        lines = [
+            orjson.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._build_request(corrections, text)
+            })
+            for i, (corrections, text) in enumerate(zip(correction_batches, original_texts))
+        ]
+        
+        batch_file = await self.client.files.create(
+            file=("discriminator_batch.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Submitted discriminator batch {batch.id} with {len(lines)} requests")
+        
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+        
+        if batch.status != "completed":
+            raise RuntimeError(f"Discriminator batch {batch.id} ended with status '{batch.status}'")
+        
+        # Demux the output file by custom_id
+        verdicts = {}
+        if batch.output_file_id:
+            output = await self.client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    record = orjson.loads(line)
+                    response = record.get("response") or {}
+                    if response.get("status_code") != 200:
+                        logger.error(f"Batch request {record.get('custom_id')} failed: {record.get('error')}")
+                        continue
+                    content = response["body"]["choices"][0]["message"]["content"]
+                    verdicts[int(record["custom_id"])] = ValidationResult.model_validate_json(content)
+                except (KeyError, IndexError, TypeError, ValueError) as e:
+                    logger.error(f"Could not parse batch output line: {e}")
+        
+        results = []
+        for i, corrections in enumerate(correction_batches):
+            if i in verdicts:
+                results.append(self._apply_quality_filter(corrections, verdicts[i], min_quality_score))
+            else:
                 # Fallback to original corrections
-                filtered_results.append((
-                    correction_batches[i], 
-                    {"error": str(result), "discriminator_used": False}
+                results.append((
+                    corrections,
+                    {"error": "No batch result returned", "discriminator_used": False}
                 ))
-            else:
-                filtered_results.append(result)
         
-        return filtered_results
+        logger.info(f"Discriminator batch {batch.id} completed: {len(verdicts)}/{len(correction_batches)} results")
+        return results
 
 
 # Test functions
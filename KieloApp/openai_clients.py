@@ -0,0 +1,41 @@
+"""
+Shared OpenAI clients
+
+One AsyncOpenAI client per API key, used by both the grammar checker and the
+discriminator, so all their calls share one HTTP/2 connection pool (keep-alive
+TLS sessions, multiplexed concurrent requests) across requests.
+"""
+
+# openai and httpx are imported when the first client is created, so importing
+# this module stays cheap
+_clients = {}
+
+
+def get_client(api_key):
+    """Return the shared AsyncOpenAI client for the given API key."""
+    client = _clients.get(api_key)
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        client = AsyncOpenAI(
+            api_key=api_key,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=50,
+                    keepalive_expiry=60
+                ),
+                http2=True
+            )
+        )
+        _clients[api_key] = client
+    return client
+
+
+async def close_clients():
+    """Close all shared clients; call this on application shutdown."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.close()
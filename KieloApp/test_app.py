@@ -0,0 +1,90 @@
+"""
+Offline checks for app.py
+Tests users.txt parsing and the JWT login round trip without calling OpenAI.
+"""
+
+import logging
+import os
+import tempfile
+
+from fastapi.testclient import TestClient
+
+import app
+
+
+USERS_TXT = (
+    'Username: alice\n'
+    'Password: secret\n'
+    'API-Key: "sk-alice"\n'
+    '\n'
+    'Username: carol\r\n'
+    'Password:   two words  \r\n'
+    '\r\n'
+    'API-Key: sk-carol\r\n'
+    '\n'
+    'Username: dave\n'
+    'Password:\n'
+    'API-Key: sk-dave\n'
+)
+
+
+def load_test_users():
+    """Parse USERS_TXT through load_users, as the app does on startup."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "users.txt")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(USERS_TXT)
+        return app.load_users(path)
+
+
+class WarningCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_load_users():
+    """Passwords with spaces, CRLF, blank lines and quoted keys; malformed blocks are reported."""
+    collector = WarningCollector()
+    logging.getLogger().addHandler(collector)
+    try:
+        users = load_test_users()
+    finally:
+        logging.getLogger().removeHandler(collector)
+
+    assert users == [("alice", "secret", "sk-alice"), ("carol", "two words", "sk-carol")], users
+    assert any("Skipped 1 malformed user block" in m for m in collector.messages), collector.messages
+    print("✅ users.txt parsed, malformed block reported")
+
+
+def test_login_round_trip():
+    """A token from /login is accepted by /process_sections; bad passwords and tokens are not."""
+    with TestClient(app.app) as client:
+        # Replace whatever the startup hook loaded with the test users
+        users = load_test_users()
+        app.USERS_BY_NAME = app.index_users(users)
+        app.API_KEYS_BY_ID = {app.api_key_id(k): k for (u, p, k) in users}
+
+        assert client.post("/login", json={"username": "carol", "password": "wrong"}).status_code == 401
+        assert client.post("/login", json={"username": "nobody", "password": "x"}).status_code == 401
+
+        response = client.post("/login", json={"username": "carol", "password": "two words"})
+        assert response.status_code == 200, response.text
+        token = response.json()["session_token"]
+
+        # Empty selections fail validation after the token has been accepted
+        request = {"session_token": token, "selected_titles": [], "text_for_corrections": "Teksti."}
+        response = client.post("/process_sections", json=request)
+        assert response.status_code == 400, response.text
+
+        request["session_token"] = token[:-2] + ("AA" if not token.endswith("AA") else "BB")
+        assert client.post("/process_sections", json=request).status_code == 401
+    print("✅ JWT login round trip")
+
+
+if __name__ == "__main__":
+    test_load_users()
+    test_login_round_trip()
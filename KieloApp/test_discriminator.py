@@ -1,11 +1,67 @@
 """
 Test script for the Grammar Discriminator
-Tests the discriminator with real API calls and sample data
+Tests the discriminator with real API calls and sample data.
+
+OpenAI responses are recorded to tests/cassettes on the first run and
+replayed from disk afterwards; set PYTEST_LIVE=1 to always call the API.
 """
 
 import asyncio
+import contextlib
 import json
-from discriminator import GrammarDiscriminator
+import os
+from types import SimpleNamespace
+import vcr
+from discriminator import GrammarDiscriminator, VerdictCache
+
+
+CASSETTE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "cassettes")
+
+recorder = vcr.VCR(
+    cassette_library_dir=CASSETTE_DIR,
+    record_mode="new_episodes",
+    # Every call goes to the same URL, so the prompt body tells requests apart
+    match_on=["method", "uri", "body"],
+    filter_headers=["authorization"],
+)
+
+
+def live_api():
+    """Return True if the tests should bypass the cassettes."""
+    return os.environ.get("PYTEST_LIVE") == "1"
+
+
+def use_cassette(name):
+    """Record/replay OpenAI traffic for one test unless running live."""
+    if live_api():
+        return contextlib.nullcontext()
+    # Without a real API key new requests cannot be recorded, only replayed
+    record_mode = "new_episodes" if load_api_key() else "none"
+    return recorder.use_cassette(f"{name}.yaml", record_mode=record_mode)
+
+
+def cassette_missing(name):
+    """Return True if a cassette must be replayed but has not been recorded."""
+    if live_api() or load_api_key():
+        return False
+    return not os.path.exists(os.path.join(CASSETTE_DIR, f"{name}.yaml"))
+
+
+async def run_recorded(name, test):
+    """Run one API test inside its cassette; a missing cassette is a failure."""
+    if cassette_missing(name):
+        print(f"❌ No cassette {name}.yaml and no API key to record it.")
+        return False
+    with use_cassette(name):
+        return await test()
+
+
+def get_api_key():
+    """Return the real API key, or a placeholder when replaying cassettes."""
+    api_key = load_api_key()
+    if api_key is None and not live_api():
+        return "cassette-replay"
+    return api_key
 
 
 def load_api_key():
@@ -35,15 +91,16 @@ async def test_discriminator_real():
     """Test discriminator with real API calls."""
     
     # Load API key
-    api_key = load_api_key()
+    api_key = get_api_key()
     if not api_key:
         print("❌ No API key found. Cannot test with real API calls.")
         return
     
     print("🔑 API key loaded successfully")
     
-    # Initialize discriminator
-    discriminator = GrammarDiscriminator(api_key)
+    # Initialize discriminator; a fresh in-memory cache keeps earlier runs'
+    # verdicts from answering requests before they reach the cassette
+    discriminator = GrammarDiscriminator(api_key, cache=VerdictCache())
     
     # Test corrections - mix of good and problematic ones
     test_corrections = [
@@ -96,6 +153,11 @@ async def test_discriminator_real():
         print(f"📊 Quality score: {metadata['quality_score']}/100")
         print(f"📝 Summary: {metadata['summary']}")
         
+        # The discriminator falls back to all corrections when the call fails
+        if metadata.get("error"):
+            print(f"❌ Validation failed: {metadata['error']}")
+            return False
+        
         print("\n=== VALID CORRECTIONS ===")
         for i, correction in enumerate(filtered_corrections, 1):
             print(f"{i}. {correction['original_sentence']}")
@@ -130,12 +192,12 @@ async def test_discriminator_real():
 async def test_batch_validation():
     """Test batch validation functionality."""
     
-    api_key = load_api_key()
+    api_key = get_api_key()
     if not api_key:
         print("❌ No API key found for batch test.")
         return
     
-    discriminator = GrammarDiscriminator(api_key)
+    discriminator = GrammarDiscriminator(api_key, cache=VerdictCache())
     
     # Create multiple batches
     batch1 = [
@@ -158,26 +220,165 @@ async def test_batch_validation():
         print("\n=== BATCH VALIDATION TEST ===")
         results = await discriminator.batch_validate([batch1, batch2])
         
+        success = True
         for i, (corrections, metadata) in enumerate(results, 1):
             print(f"Batch {i}: {len(corrections)} valid corrections")
             print(f"Quality: {metadata.get('quality_score', 'N/A')}/100")
+            if metadata.get("error"):
+                print(f"❌ Batch {i} validation failed: {metadata['error']}")
+                success = False
         
-        return True
+        return success
         
     except Exception as e:
         print(f"❌ Batch validation error: {e}")
         return False
 
 
+class FakeClient:
+    """Minimal stand-in for AsyncOpenAI around a fake completions object."""
+
+    def __init__(self, completions):
+        self.chat = SimpleNamespace(completions=completions)
+
+    def with_options(self, **kwargs):
+        return self
+
+
+class FakeStreamingCompletions:
+    """Streams a fixed discriminator verdict a few characters per chunk."""
+
+    def __init__(self, verdict, chunk_size=7):
+        self.verdict = verdict
+        self.chunk_size = chunk_size
+
+    async def create(self, **kwargs):
+        content = json.dumps(self.verdict, ensure_ascii=False)
+
+        async def stream():
+            for start in range(0, len(content), self.chunk_size):
+                delta = SimpleNamespace(content=content[start:start + self.chunk_size])
+                yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=delta)])
+
+        return stream()
+
+
+class FakeCombinedCompletions:
+    """
+    Answers combined batch requests with string ids and leaves out the
+    highest id, so that batch has to be validated with a separate call.
+    """
+
+    def __init__(self):
+        self.combined_calls = 0
+        self.single_calls = 0
+        self.omitted_ids = []
+
+    async def create(self, **kwargs):
+        header, _, body = kwargs["messages"][-1]["content"].partition("\n")
+        if header == "ARVIOITAVAT KORJAUSERÄT:":
+            self.combined_calls += 1
+            batches = json.loads(body)["batches"]
+            self.omitted_ids.append(max(batch["id"] for batch in batches))
+            answer = {"results": [
+                {"id": str(batch["id"]), "valid_corrections": batch["corrections"],
+                 "rejected_corrections": [], "quality_score": 95, "summary": "Yhdistetty"}
+                for batch in batches if batch["id"] != self.omitted_ids[-1]
+            ]}
+        else:
+            self.single_calls += 1
+            corrections = json.loads(body.split("\n\nALKUPERÄINEN TEKSTI KONTEKSTIKSI:")[0])
+            answer = {"valid_corrections": corrections, "rejected_corrections": [],
+                      "quality_score": 80, "summary": "Erillinen"}
+        message = SimpleNamespace(content=json.dumps(answer, ensure_ascii=False))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+async def test_combined_validation():
+    """Test that batch_validate maps a combined answer back to its batches (no API calls)."""
+    
+    batches = [
+        [{
+            "original_sentence": f"Tämä on hyvä kirja numero {n}.",
+            "explanation": "Muuta 'hyvä' sanaksi 'erinomainen'.",
+            "corrected_sentence": f"Tämä on erinomainen kirja numero {n}."
+        }] * n
+        for n in (3, 1, 2)
+    ]
+    # One text too few: the last batch is validated without context
+    texts = ["Ensimmäinen teksti.", "Toinen teksti."]
+    
+    completions = FakeCombinedCompletions()
+    discriminator = GrammarDiscriminator("offline", client=FakeClient(completions), cache=VerdictCache())
+    
+    print("\n=== COMBINED VALIDATION TEST ===")
+    results = await discriminator.batch_validate(batches, texts)
+    
+    omitted = completions.omitted_ids[0] if completions.omitted_ids else None
+    expected_scores = [80 if i == omitted else 95 for i in range(len(batches))]
+    scores = [metadata.get("quality_score") for _, metadata in results]
+    if (len(results) != len(batches)
+            or [corrections for corrections, _ in results] != batches
+            or scores != expected_scores
+            or (completions.combined_calls, completions.single_calls) != (1, 1)):
+        print(f"❌ Combined validation returned scores {scores}, expected {expected_scores}; "
+              f"{completions.combined_calls} combined and {completions.single_calls} separate calls")
+        return False
+    
+    print(f"{len(results)} batches validated with one combined and one separate call")
+    return True
+
+
+async def test_streamed_validation():
+    """Test that iter_valid_corrections parses a chunked verdict (no API calls)."""
+    
+    corrections = [
+        {
+            "original_sentence": "Minä olen opiskelut suomea monta vuotta.",
+            "explanation": "Partisiippimuodon korjaus: 'opiskelut' pitäisi olla 'opiskellut'.",
+            "corrected_sentence": "Minä olen opiskellut suomea monta vuotta."
+        },
+        {
+            "original_sentence": "Tämä on hyvä kirja.",
+            "explanation": "Muuta 'hyvä' sanaksi 'erinomainen' paremman ilmaisun vuoksi.",
+            "corrected_sentence": "Tämä on erinomainen kirja."
+        }
+    ]
+    verdict = {
+        "valid_corrections": corrections[:1],
+        "rejected_corrections": [{"correction": corrections[1], "reason": "Tyylimuutos"}],
+        "quality_score": 90,
+        "summary": "Yksi korjaus hyväksytty."
+    }
+    
+    cache = VerdictCache()
+    client = FakeClient(FakeStreamingCompletions(verdict))
+    discriminator = GrammarDiscriminator("offline", client=client, cache=cache)
+    
+    print("\n=== STREAMED VALIDATION TEST ===")
+    streamed = [c async for c in discriminator.iter_valid_corrections(corrections)]
+    model_corrections = discriminator._partition_corrections(corrections)[2]
+    cached = await cache.get(cache.make_key(discriminator.model, model_corrections, ""))
+    
+    if streamed != verdict["valid_corrections"] or cached is None or cached.quality_score != 90:
+        print(f"❌ Streamed validation returned {len(streamed)} corrections, cached verdict: {cached}")
+        return False
+    
+    print(f"Streamed {len(streamed)} valid corrections, verdict cached")
+    return True
+
+
 async def main():
     """Main test function."""
     print("=== FINNISH GRAMMAR DISCRIMINATOR TESTING ===\n")
     
     # Test discriminator functionality
-    success1 = await test_discriminator_real()
-    success2 = await test_batch_validation()
+    success1 = await run_recorded("discriminator_real", test_discriminator_real)
+    success2 = await run_recorded("batch_validation", test_batch_validation)
+    success3 = await test_streamed_validation()
+    success4 = await test_combined_validation()
     
-    if success1 and success2:
+    if success1 and success2 and success3 and success4:
         print("\n🎉 All discriminator tests passed successfully!")
     else:
         print("\n⚠️  Some tests failed. Check error messages above.")
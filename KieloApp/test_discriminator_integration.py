@@ -4,63 +4,74 @@ Test script to demonstrate discriminator integration with the API
 
 import asyncio
 import json
-import requests
+import aiohttp
 
-def test_api_with_discriminator():
+BASE_URL = "http://localhost:5000"
+
+
+async def process_case(session, session_token, case):
+    """Run one test case against /process_sections and return (case, status, result)."""
+    async with session.post(f"{BASE_URL}/process_sections",
+                            json={
+                                "session_token": session_token,
+                                "selected_titles": ["Test"],
+                                "text_for_corrections": case['text'],
+                                "n_responses": 1,
+                                "selected_model": "fast"
+                            }) as response:
+        if response.status != 200:
+            return case, response.status, None
+        return case, response.status, await response.json()
+
+
+async def test_api_with_discriminator():
     """Test the API with discriminator enabled"""
     
-    # Login first
-    login_response = requests.post("http://localhost:5000/login", 
-                                 json={"username": "AIBooks1", "password": "Nalle2016"})
-    
-    if login_response.status_code != 200:
-        print("❌ Login failed")
-        return
-    
-    session_token = login_response.json()["session_token"]
-    print(f"✅ Logged in successfully")
-    
-    # Test text with mixed quality corrections
-    test_cases = [
-        {
-            "name": "High Quality Corrections",
-            "text": "Minä olen opiskelut suomea. Google Could Platform on hyvä palvelu. Maailman laajuinen pandemia vaikutti kaikkiin.",
-            "expected_quality": "high"
-        },
-        {
-            "name": "Mixed Quality Corrections", 
-            "text": "Kissa on musta. Hyvä kirja on pöydällä. Auto on nopeaa.",
-            "expected_quality": "mixed"
-        },
-        {
-            "name": "Good Text (No Corrections Needed)",
-            "text": "Tämä on hyvin kirjoitettu teksti. Kaikki sanat ovat oikeassa muodossa ja lauserakenne on selkeä.",
-            "expected_quality": "high"
-        }
-    ]
-    
-    print("\n=== DISCRIMINATOR INTEGRATION TEST ===")
+    connector = aiohttp.TCPConnector(limit=32, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # Login first
+        async with session.post(f"{BASE_URL}/login", 
+                                json={"username": "AIBooks1", "password": "Nalle2016"}) as login_response:
+            if login_response.status != 200:
+                print("❌ Login failed")
+                return
+            session_token = (await login_response.json())["session_token"]
+        print(f"✅ Logged in successfully")
+        
+        # Test text with mixed quality corrections
+        test_cases = [
+            {
+                "name": "High Quality Corrections",
+                "text": "Minä olen opiskelut suomea. Google Could Platform on hyvä palvelu. Maailman laajuinen pandemia vaikutti kaikkiin.",
+                "expected_quality": "high"
+            },
+            {
+                "name": "Mixed Quality Corrections", 
+                "text": "Kissa on musta. Hyvä kirja on pöydällä. Auto on nopeaa.",
+                "expected_quality": "mixed"
+            },
+            {
+                "name": "Good Text (No Corrections Needed)",
+                "text": "Tämä on hyvin kirjoitettu teksti. Kaikki sanat ovat oikeassa muodossa ja lauserakenne on selkeä.",
+                "expected_quality": "high"
+            }
+        ]
+        
+        print("\n=== DISCRIMINATOR INTEGRATION TEST ===")
+        
+        # Make all API calls concurrently
+        outcomes = await asyncio.gather(
+            *(process_case(session, session_token, case) for case in test_cases)
+        )
     
-    for case in test_cases:
+    for case, status_code, result in outcomes:
         print(f"\n📝 Testing: {case['name']}")
         print(f"Text: {case['text'][:50]}...")
         
-        # Make API call
-        response = requests.post("http://localhost:5000/process_sections",
-                               json={
-                                   "session_token": session_token,
-                                   "selected_titles": ["Test"],
-                                   "text_for_corrections": case['text'],
-                                   "n_responses": 1,
-                                   "selected_model": "fast"
-                               })
-        
-        if response.status_code != 200:
-            print(f"❌ API call failed: {response.status_code}")
+        if status_code != 200:
+            print(f"❌ API call failed: {status_code}")
             continue
         
-        result = response.json()
-        
         if result["results"]:
             corrections = result["results"][0]["corrections"]
             suggestion = result["results"][0]["suggestion"]
@@ -82,4 +93,4 @@ def test_api_with_discriminator():
     print("\n🎉 Discriminator integration test completed!")
 
 if __name__ == "__main__":
-    test_api_with_discriminator()
\ No newline at end of file
+    asyncio.run(test_api_with_discriminator())
\ No newline at end of file
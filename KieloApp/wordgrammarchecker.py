@@ -1,27 +1,150 @@
 import asyncio
-import json
+import hashlib
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 
-logging.basicConfig(level=logging.DEBUG, filename='debug.log', 
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+import fastjsonschema
+import orjson
 
-from openai import AsyncOpenAI
-from discriminator import GrammarDiscriminator
+from openai_clients import close_clients, get_client
 
+# openai (with its pydantic models), httpx and the discriminator are imported
+# on first use, so importing this module stays cheap
+
+# Handlers and levels are configured by the application entrypoint (app.py)
+logger = logging.getLogger("kielo.wordgrammar")
+
+# Preface of the user message; the text to check is appended to it
+_USER_PROMPT_PREFIX = (
+    "Tämä on teksti, josta ehkä voit löytää virheitä, "
+    "mutta älä kuitenkaan väkisin yritä löytää virheitä "
+    "sieltä, missä niitä ei ole:\n\n"
+)
+
+# Structured output schema; sent unchanged with every request
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "my_schema",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "name": {
+                    "type": "string",
+                    "description": "The name of the schema"
+                },
+                "type": {
+                    "type": "string",
+                    "enum": ["object"]
+                },
+                "properties": {
+                    "type": "object",
+                    "properties": {
+                        "corrections": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "original_sentence": {
+                                        "type": ["string","null"]
+                                    },
+                                    "explanation": {
+                                        "type": ["string","null"]
+                                    },
+                                    "corrected_sentence": {
+                                        "type": ["string","null"]
+                                    }
+                                },
+                                "required": [
+                                    "original_sentence",
+                                    "explanation",
+                                    "corrected_sentence"
+                                ],
+                                "additionalProperties": False
+                            }
+                        },
+                        "suggestion": {
+                            "type": "string"
+                        }
+                    },
+                    "required": ["corrections","suggestion"],
+                    "additionalProperties": False
+                }
+            },
+            "$defs": {},
+            "required": ["name","type","properties"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Compiled once; the model is asked to follow the schema, but truncated or
+# off-schema output still has to be rejected before it reaches the client
+_VALIDATE = fastjsonschema.compile(_RESPONSE_FORMAT["json_schema"]["schema"])
 
 
 class WordGrammarChecker:
+    # Response log descriptor shared by all checkers, opened on first write.
+    # Each record is a single O_APPEND write, so records from concurrent
+    # requests and worker processes do not interleave.
+    log_path = "word_grammar_checker.log"
+    _log_fd = None
+    _log_fd_lock = threading.Lock()
+
+    # Results of recent checks, shared by all checkers since app.py creates one
+    # per request. Resubmitting the same text (e.g. a retry from the add-in)
+    # is answered without calling the API again. Only complete results are
+    # stored, and entries expire after result_cache_ttl seconds.
+    _result_cache = OrderedDict()
+    result_cache_size = 256
+    result_cache_ttl = 600
+
+    @classmethod
+    def _write_log(cls, data):
+        """Append an encoded record to the response log; runs in a worker thread."""
+        if cls._log_fd is None:
+            with cls._log_fd_lock:
+                if cls._log_fd is None:
+                    cls._log_fd = os.open(cls.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(cls._log_fd, data)
+
+    @classmethod
+    def get_client(cls, api_key):
+        """Return the shared AsyncOpenAI client for the given API key."""
+        return get_client(api_key)
+
+    @classmethod
+    async def aclose(cls):
+        """Close all shared clients and the response log; call this on application shutdown."""
+        await close_clients()
+        with cls._log_fd_lock:
+            if cls._log_fd is not None:
+                os.close(cls._log_fd)
+                cls._log_fd = None
+
     def __init__(self, api_key, system_prompt, max_concurrent_requests=5, n_responses=1,
-                 chosen_model="fast", use_discriminator=True):
+                 chosen_model="fast", use_discriminator=True, client=None, prompt_cache_key=None):
         """
         :param chosen_model: "fast" => use gpt-4o, "slow" => use o3-mini + reasoning_effort=high
         :param use_discriminator: Whether to use the o3 discriminator for validation
+        :param client: Optional AsyncOpenAI client; defaults to the shared client for api_key
+        :param prompt_cache_key: Optional key grouping requests that share the system prompt
+            for OpenAI prompt caching, e.g. a hash of the prompt computed once by the caller
         """
         self.api_key = api_key
         self.system_prompt = system_prompt
+        self.prompt_cache_key = prompt_cache_key
         self.max_concurrent_requests = max_concurrent_requests
-        self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        # Admission counter instead of a semaphore so the limit can be resized
+        # at runtime (see set_limit)
+        self._cv = asyncio.Condition()
+        self._active = 0
+        self._limit = max_concurrent_requests
         self.n_responses = n_responses
         self.text_data = ""
         self.use_discriminator = use_discriminator
@@ -32,15 +155,22 @@ class WordGrammarChecker:
         if self.api_key and (self.api_key.startswith('"') or self.api_key.startswith("'")):
             self.api_key = self.api_key.strip('"\'')
             
-        self.client = AsyncOpenAI(api_key=self.api_key)
+        self.client = client or self.get_client(self.api_key)
         
         # Initialize discriminator if enabled
         if self.use_discriminator:
-            self.discriminator = GrammarDiscriminator(self.api_key)
-            logging.info("Discriminator initialized with o3 model")
+            from discriminator import GrammarDiscriminator
+
+            self.discriminator = GrammarDiscriminator(self.api_key, client=self.client)
+            logger.info("Discriminator initialized with o3 model")
         else:
             self.discriminator = None
-            logging.info("Discriminator disabled")
+            logger.info("Discriminator disabled")
+
+        # Built once and never modified, since concurrent process_text calls
+        # share it; each call builds its own messages list around the text
+        self._payload_template = self.create_payload()
+        self._system_msg = self._payload_template["messages"][0]
 
     def create_payload(self):
         # Decide model
@@ -59,112 +189,117 @@ class WordGrammarChecker:
                 {"role": system_role_key, "content": self.system_prompt},
                 {
                     "role": "user",
-                    "content": (
-                        "Tämä on teksti, josta ehkä voit löytää virheitä, "
-                        "mutta älä kuitenkaan väkisin yritä löytää virheitä "
-                        "sieltä, missä niitä ei ole:\n\n" + self.text_data
-                    )
+                    "content": "".join((_USER_PROMPT_PREFIX, self.text_data))
                 }
             ],
-            "response_format": {
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "my_schema",
-                    "strict": True,
-                    "schema": {
-                        "type": "object",
-                        "properties": {
-                            "name": {
-                                "type": "string",
-                                "description": "The name of the schema"
-                            },
-                            "type": {
-                                "type": "string",
-                                "enum": ["object"]
-                            },
-                            "properties": {
-                                "type": "object",
-                                "properties": {
-                                    "corrections": {
-                                        "type": "array",
-                                        "items": {
-                                            "type": "object",
-                                            "properties": {
-                                                "original_sentence": {
-                                                    "type": ["string","null"]
-                                                },
-                                                "explanation": {
-                                                    "type": ["string","null"]
-                                                },
-                                                "corrected_sentence": {
-                                                    "type": ["string","null"]
-                                                }
-                                            },
-                                            "required": [
-                                                "original_sentence",
-                                                "explanation",
-                                                "corrected_sentence"
-                                            ],
-                                            "additionalProperties": False
-                                        }
-                                    },
-                                    "suggestion": {
-                                        "type": "string"
-                                    }
-                                },
-                                "required": ["corrections","suggestion"],
-                                "additionalProperties": False
-                            }
-                        },
-                        "$defs": {},
-                        "required": ["name","type","properties"],
-                        "additionalProperties": False
-                    }
-                }
-            }
+            # All samples come from one request instead of n separate calls
+            "n": self.n_responses,
+            # Streamed so the body is received while the model is still generating
+            "stream": True,
+            "response_format": _RESPONSE_FORMAT
         }
         # If "slow", we set reasoning_effort="high"
         if reasoning_effort:
             payload["reasoning_effort"] = "high"
+        if self.prompt_cache_key:
+            payload["prompt_cache_key"] = self.prompt_cache_key
 
         return payload
 
+    async def set_limit(self, n):
+        """
+        Change the number of concurrent API calls, e.g. to back off after rate
+        limiting. Waiting calls are woken up if the limit grows.
+        """
+        async with self._cv:
+            self._limit = max(1, n)
+            self.max_concurrent_requests = self._limit
+            self._cv.notify_all()
+
     async def make_api_call(self, payload):
-        async with self.semaphore:
-            try:
-                logging.debug(f"Making OpenAI API call with model: {payload.get('model')}")
-                response = await self.client.chat.completions.create(**payload)
-                logging.debug(f"Received response: {response}")
-                return response
-            except Exception as e:
-                logging.error(f"OpenAI call failed: {e}")
-                return None
-
-    def extract_corrections(self, response_model):
-        if not response_model:
-            return [], ""
-        resp_dict = response_model.model_dump()
-        choices = resp_dict.get("choices", [])
-        if not choices:
-            return [], ""
-
-        content = choices[0].get("message",{}).get("content","")
+        """
+        Stream a completion and return the JSON content of each choice as bytes,
+        ordered by choice index. API and transport errors propagate to the caller.
+        """
+        async with self._cv:
+            await self._cv.wait_for(lambda: self._active < self._limit)
+            self._active += 1
         try:
-            data = json.loads(content)
-            props = data.get("properties", {})
-            corrections = props.get("corrections", [])
-            suggestion = props.get("suggestion", "")
-            return corrections, suggestion
-        except json.JSONDecodeError:
-            return [], ""
-
-    async def process_text(self, text):
-        self.text_data = text
-        payload = self.create_payload()
-
-        logging.info(f"API Key Status: {'*****VALID*****' if self.api_key else 'MISSING OR EMPTY'}")
-        logging.info(f"API Key First 10 chars: {self.api_key[:10] if self.api_key else 'NONE'}...")
-        logging.info(f"Model being used: {payload.get('model', 'unknown')}")
+            logger.debug("Making OpenAI API call with model: %s", payload.get("model"))
+            stream = await self.client.chat.completions.create(**payload)
+            buffers = {}
+            async for chunk in stream:
+                for choice in chunk.choices:
+                    if choice.delta.content:
+                        buffer = buffers.setdefault(choice.index, bytearray())
+                        buffer += choice.delta.content.encode("utf-8")
+            contents = [bytes(buffers.get(i, b"")) for i in range(payload.get("n", 1))]
+            logger.debug("Received response: %s", contents)
+            return contents
+        finally:
+            async with self._cv:
+                self._active -= 1
+                self._cv.notify(1)
+
+    def extract_corrections(self, content, index=0):
+        """Return (corrections, suggestion) parsed from the JSON content of choice index."""
+        return self._parse_choice(content, index) or ([], "")
+
+    def _parse_choice(self, content, index):
+        """Like extract_corrections, but return None if the content is unusable."""
+        if not content:
+            logger.warning("Response %d is empty", index + 1)
+            return None
+        try:
+            data = orjson.loads(content)
+            _VALIDATE(data)
+            props = data["properties"]
+            return props["corrections"], props["suggestion"]
+        except orjson.JSONDecodeError as e:
+            logger.warning("Response %d is not valid JSON: %s", index + 1, e)
+            return None
+        except fastjsonschema.JsonSchemaException as e:
+            logger.warning("Response %d does not match the response schema: %s", index + 1, e.message)
+            return None
+        except (KeyError, TypeError):
+            return None
+
+    def _result_cache_key(self, text):
+        return (
+            self.chosen_model,
+            self.n_responses,
+            self.use_discriminator,
+            self.system_prompt,
+            hashlib.blake2b(text.encode("utf-8")).digest(),
+        )
+
+    async def process_text(self, text, cache_text=None):
+        """
+        Check text and return (results_per_response, raw responses).
+        :param cache_text: Optional normalized form of text used as the result
+            cache key, so texts differing only in whitespace share an entry
+        """
+        cache_key = self._result_cache_key(cache_text if cache_text is not None else text)
+        cached = self._result_cache.get(cache_key)
+        if cached is not None:
+            expires, result = cached
+            if expires > time.monotonic():
+                self._result_cache.move_to_end(cache_key)
+                logger.info("Returning cached results for a previously checked text")
+                return result
+            del self._result_cache[cache_key]
+
+        payload = {
+            **self._payload_template,
+            "messages": [
+                self._system_msg,
+                {"role": "user", "content": "".join((_USER_PROMPT_PREFIX, text))}
+            ]
+        }
+
+        logger.info("API Key Status: %s", "*****VALID*****" if self.api_key else "MISSING OR EMPTY")
+        logger.info("API Key First 10 chars: %s...", self.api_key[:10] if self.api_key else "NONE")
+        logger.info("Model being used: %s", payload.get("model", "unknown"))
 
         # For debugging - to be commented out when API is working
         # mock_response = {
@@ -178,55 +313,123 @@ class WordGrammarChecker:
         #     "suggestion": "Tekstissä oli kielioppivirhe, jossa käytettiin ylimääräistä apuverbiä 'on' yhdessä perusmuotoisen verbin kanssa."
         # }
 
-        calls = [self.make_api_call(payload) for _ in range(self.n_responses)]
-        responses = await asyncio.gather(*calls)
+        # One request returns n_responses choices
+        import httpx
+        from openai import OpenAIError
 
-        responses = [r for r in responses if r is not None]
+        try:
+            responses = await self.make_api_call(payload)
+        except (OpenAIError, httpx.HTTPError):
+            # The caller tells a rejected text (BadRequestError) apart from
+            # rate limits and outages; neither may look like "no errors found"
+            logger.exception("OpenAI call failed")
+            raise
 
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        with open("word_grammar_checker.log", "a", encoding="utf-8") as f:
-            f.write(f"--- NEW SET OF RESPONSES at {timestamp} ---\n")
-            if responses:
-                for idx, resp_model in enumerate(responses):
-                    resp_dict = resp_model.model_dump()
-                    f.write(f"Response {idx+1}:\n")
-                    f.write(json.dumps(resp_dict, ensure_ascii=False, indent=2))
-                    f.write("\n\n")
-            else:
-                f.write("No valid responses received.\n\n")
-                f.write("API KEY ISSUE: Using mock response for testing\n")
+        chunks = [f"--- NEW SET OF RESPONSES at {timestamp} ---\n".encode()]
+        if responses:
+            # The streamed content is already UTF-8 JSON and is logged as is
+            for idx, content in enumerate(responses):
+                chunks.append(f"Response {idx+1}:\n".encode())
+                chunks.append(content)
+                chunks.append(b"\n\n")
+        else:
+            chunks.append(b"No valid responses received.\n\n")
+            chunks.append(b"API KEY ISSUE: Using mock response for testing\n")
+        # One write per set of responses, off the event loop so other
+        # in-flight API calls keep progressing during disk I/O
+        await asyncio.to_thread(self._write_log, b"".join(chunks))
 
         if not responses:
-            logging.error("No valid responses received.")
+            logger.error("No valid responses received.")
             return [], responses
 
-        results_per_response = []
-        for resp_model in responses:
-            corrections, suggestion = self.extract_corrections(resp_model)
-            
-            # Apply discriminator filtering if enabled
-            if self.use_discriminator and self.discriminator and corrections:
+        parsed = [self._parse_choice(content, idx) for idx, content in enumerate(responses)]
+        complete = all(p is not None for p in parsed)
+        results_per_response = [p or ([], "") for p in parsed]
+
+        # Apply discriminator filtering if enabled
+        if self.use_discriminator and self.discriminator:
+            complete = await self._apply_discriminator(results_per_response, text) and complete
+
+        # Truncated or off-schema responses and discriminator fallbacks are
+        # transient, so a retry of the same text must call the API again
+        if complete:
+            self._result_cache[cache_key] = (
+                time.monotonic() + self.result_cache_ttl,
+                (results_per_response, responses),
+            )
+            if len(self._result_cache) > self.result_cache_size:
+                self._result_cache.popitem(last=False)
+
+        return results_per_response, responses
+
+    async def _discriminate(self, corrections, suggestion, text):
+        """
+        Filter one response's corrections and note the verdict in the suggestion.
+        Returns (corrections, suggestion, error), where error is set if the
+        discriminator fell back to the unvalidated corrections.
+        """
+        logger.info("Applying discriminator to %d corrections", len(corrections))
+        filtered_corrections, metadata = await self.discriminator.filter_corrections(
+            corrections, 
+            text
+        )
+        
+        # Log discriminator results
+        logger.info("Discriminator results: %s/%s corrections passed, quality score: %s/100",
+                    metadata['filtered_count'], metadata['original_count'], metadata['quality_score'])
+        
+        # Update suggestion to include discriminator info
+        discriminator_note = f" (Discriminator: {metadata['filtered_count']}/{metadata['original_count']} korjausta hyväksytty, laatu: {metadata['quality_score']}/100)"
+        suggestion = (suggestion or "tarvetta kielioppikorjauksille") + discriminator_note
+        
+        return filtered_corrections, suggestion, metadata.get("error")
+
+    async def _apply_discriminator(self, results_per_response, text):
+        """
+        Validate every response that has corrections, replacing its entry in
+        results_per_response. A pool of at most max_concurrent_requests workers
+        takes responses from a queue, and each result is stored as soon as its
+        worker finishes. Returns False if any response kept its corrections
+        because validation failed.
+        """
+        jobs = asyncio.Queue()
+        for idx, (corrections, _) in enumerate(results_per_response):
+            if corrections:
+                jobs.put_nowait(idx)
+        pending = jobs.qsize()
+        if not pending:
+            return True
+
+        done = asyncio.Queue()
+
+        async def worker():
+            while True:
+                try:
+                    idx = jobs.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                # Like gather(return_exceptions=True): a failure is handed to the
+                # consumer as the result and does not stop this worker
                 try:
-                    logging.info(f"Applying discriminator to {len(corrections)} corrections")
-                    filtered_corrections, metadata = await self.discriminator.filter_corrections(
-                        corrections, 
-                        self.text_data
-                    )
-                    
-                    # Log discriminator results
-                    logging.info(f"Discriminator results: {metadata['filtered_count']}/{metadata['original_count']} corrections passed, "
-                               f"quality score: {metadata['quality_score']}/100")
-                    
-                    # Update suggestion to include discriminator info
-                    discriminator_note = f" (Discriminator: {metadata['filtered_count']}/{metadata['original_count']} korjausta hyväksytty, laatu: {metadata['quality_score']}/100)"
-                    suggestion = (suggestion or "tarvetta kielioppikorjauksille") + discriminator_note
-                    
-                    corrections = filtered_corrections
-                    
+                    result = await self._discriminate(*results_per_response[idx], text)
                 except Exception as e:
-                    logging.error(f"Discriminator error: {e}")
-                    # Continue with original corrections if discriminator fails
-            
-            results_per_response.append((corrections, suggestion))
+                    result = e
+                await done.put((idx, result))
 
-        return results_per_response, responses
+        workers = [asyncio.create_task(worker()) for _ in range(min(self._limit, pending))]
+        validated = True
+        for _ in range(pending):
+            idx, result = await done.get()
+            if isinstance(result, Exception):
+                logger.error("Discriminator error: %s", result, exc_info=result)
+                # Continue with original corrections if discriminator fails
+                validated = False
+                continue
+            corrections, suggestion, error = result
+            if error:
+                validated = False
+            results_per_response[idx] = (corrections, suggestion)
+        await asyncio.gather(*workers)
+        return validated